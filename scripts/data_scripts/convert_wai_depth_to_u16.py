@@ -0,0 +1,54 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import tqdm
+import tyro
+
+from mvsanywhere.datasets.wai_dataset import WAIDataset, _quantize_depth_u16
+
+# factor converting stored depth values to depth. Converted maps keep the
+# units of the EXRs (WAIDataset scales those by 0.01 too), so the full res and
+# target size loaders behave the same for both.
+DEPTH_SCALE = 0.01
+
+
+def convert_wai_depth_to_u16(
+    scene_dir: Path,
+    depth_mode: str = "rendered_depth",
+):
+    """
+    Convert a WAI scene's EXR depth maps to uint16 .npy files.
+
+    Each {depth_mode}/{frame}.exr gets a {depth_mode}/{frame}.npy next to it,
+    which WAIDataset loads (memory mapped) instead of the EXR. Values are
+    rounded to the nearest stored unit; invalid (nan or negative) depth is
+    stored as 0 and values beyond the uint16 range are clamped to 65535.
+    scene_meta.json gets a "depth_scale" entry for the stored units.
+
+    Args:
+        scene_dir (Path): The WAI scene directory containing scene_meta.json.
+        depth_mode (str): The folder in the scene that depth maps are read from.
+    """
+    depth_paths = sorted((scene_dir / depth_mode).glob("*.exr"))
+
+    print(f"Converting {len(depth_paths)} depth maps in {scene_dir / depth_mode}...")
+    for depth_path in tqdm.tqdm(depth_paths):
+        depth = _quantize_depth_u16(WAIDataset._load_depth(str(depth_path)))
+
+        np.save(depth_path.with_suffix(".npy"), depth)
+
+    metadata_path = scene_dir / "scene_meta.json"
+    with open(metadata_path, "r") as f:
+        capture_metadata = json.load(f)
+
+    capture_metadata["depth_scale"] = DEPTH_SCALE
+
+    with open(metadata_path, "w") as f:
+        json.dump(capture_metadata, f, indent=4)
+
+    print("Done!")
+
+
+if __name__ == "__main__":
+    tyro.cli(convert_wai_depth_to_u16)
@@ -151,7 +151,23 @@ if __name__ == "__main__":
     split_filepath = os.path.join(opts.tuple_info_file_location, split_filename)
     print(f"Processing valid frames.\n")
 
-    if opts.single_debug_scan_id is not None:
+    if hasattr(dataset_class, "precompute_valid_frames"):
+        # datasets that can compute and store valid frames for many scans
+        # themselves (e.g. WAI) do it in one go.
+        ds = dataset_class(
+            dataset_path=opts.dataset_path,
+            mv_tuple_file_suffix=None,
+            split=opts.split,
+            tuple_info_file_location=opts.tuple_info_file_location,
+            pass_frame_id=True,
+            verbose_init=False,
+        )
+        if opts.single_debug_scan_id is not None:
+            scans = [opts.single_debug_scan_id]
+        else:
+            scans = scan_names
+        ds.precompute_valid_frames(opts.split, scans, num_workers=opts.num_workers)
+    elif opts.single_debug_scan_id is not None:
         item_list = process_scan(
             opts_temp_filepath,
             opts.single_debug_scan_id,
@@ -1,13 +1,303 @@
+import functools
 import json
 import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+os.environ["OPENCV_IO_ENABLE_OPENEXR"] = "1"
+
 import cv2
 import numpy as np
+import orjson
 import torch
 
 from mvsanywhere.datasets.generic_mvs_dataset import GenericMVSDataset
 
+# flips the y and z axes of an opengl camera pose to get an opencv one.
+_GL_TO_CV = np.array(
+    [[1, -1, -1, 1], [-1, 1, 1, -1], [-1, 1, 1, -1], [1, 1, 1, 1]],
+    dtype=np.float32,
+)
+
+# OpenEXR is optional, when it's available EXR depth maps are decoded at the
+# precision they're stored at instead of through OpenCV's EXR plugin.
+try:
+    import Imath
+    import OpenEXR
+except ImportError:
+    OpenEXR = None
+
+# depth folders whose EXRs OpenEXR couldn't read, these go straight to OpenCV
+# so the failure and its warning aren't repeated for every sample.
+_OPENEXR_FAILED_DIRS = set()
+
+
+def _load_json(json_path):
+    """Parses a json file with orjson.
+
+    orjson is strict about the json spec, so files containing NaN or Infinity
+    (which Python's json module writes for invalid poses) are parsed with the
+    json module instead.
+    """
+    json_bytes = Path(json_path).read_bytes()
+    try:
+        return orjson.loads(json_bytes)
+    except orjson.JSONDecodeError:
+        return json.loads(json_bytes)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_scene_meta(metadata_path, use_sidecar=False):
+    """Loads a WAI scene_meta.json file and indexes its frames by file_path.
+
+    Results are cached process-wide, so every WAIDataset instance (and every
+    DataLoader worker forked after the cache was warmed) shares one parse per
+    scan. The returned dict is shared between callers and must not be
+    modified.
+
+    The cache is unbounded, like the per-dataset dict it replaces: shuffled
+    tuples revisit every scan each epoch, so a bounded cache would evict and
+    reload metadata on the hot path once a split has more scans than it
+    holds.
+
+    If use_sidecar is True, a pickled copy of the processed metadata is kept
+    next to the json (scene_meta.json.pkl), and is read instead of the json
+    when it is at least as new as the json. Off by default, since it writes
+    into the dataset folder and unpickles what it finds there.
+
+    Args:
+        metadata_path: path to a scene_meta.json file.
+        use_sidecar: read and write the scene_meta.json.pkl sidecar.
+
+    Returns:
+        capture_metadata: the scene metadata, where "frames" is a dict from
+            a frame's file_path to that frame's metadata.
+    """
+    sidecar_path = metadata_path + ".pkl"
+    if (
+        use_sidecar
+        and os.path.exists(sidecar_path)
+        and os.path.getmtime(sidecar_path) >= os.path.getmtime(metadata_path)
+    ):
+        with open(sidecar_path, "rb") as f:
+            return pickle.load(f)
+
+    capture_metadata = _load_json(metadata_path)
+
+    capture_metadata["frames"] = {
+        frame["file_path"]: frame for frame in capture_metadata["frames"]
+    }
+
+    if not use_sidecar:
+        return capture_metadata
+
+    # store the sidecar, but wrapped inside a try incase this directory is
+    # read only. Write to a temp file first so concurrent workers never see
+    # a partial pickle.
+    temp_path = f"{sidecar_path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, "wb") as f:
+            pickle.dump(capture_metadata, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, sidecar_path)
+    except Exception as e:
+        print(f"Couldn't save metadata cache at {sidecar_path}, cause:")
+        print(e)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    return capture_metadata
+
+
+def _compute_valid_frames(scan, metadata_path, use_sidecar=False):
+    """Finds the frames of a scan with valid poses, i.e. poses that aren't
+    inf, -inf, or nan.
+
+    This is a module level function so it can run in worker processes, see
+    WAIDataset.precompute_valid_frames.
+
+    Args:
+        scan: the name of the scan, only used for printing.
+        metadata_path: path to the scan's scene_meta.json.
+        use_sidecar: passed to _load_scene_meta.
+
+    Returns:
+        frame_ids: string array of valid frame ids.
+        dists_to_last_valid_frame: int32 array with the number of invalid
+            frames between each valid frame and the valid frame before it.
+    """
+    print(f"Computing valid frames for scene {scan}.")
+
+    frames = _load_scene_meta(metadata_path, use_sidecar)["frames"]
+    color_file_count = len(frames)
+
+    # check all poses at once, only finiteness matters here so there's no
+    # need to go through load_pose.
+    world_T_cams = np.asarray(
+        [frame["transform_matrix"] for frame in frames.values()],
+        dtype=np.float32,
+    ).reshape(color_file_count, 16)
+    valid_mask = np.isfinite(world_T_cams).all(axis=1)
+    bad_file_count = int(color_file_count - valid_mask.sum())
+
+    frame_ids = np.array(list(frames.keys()), dtype=str)[valid_mask]
+
+    # the number of bad frames since the previous valid frame is the
+    # difference in the running count of bad frames between valid frames.
+    bad_frames_so_far = np.cumsum(~valid_mask)[valid_mask]
+    dists_to_last_valid_frame = np.diff(bad_frames_so_far, prepend=0).astype(np.int32)
+
+    print(f"Scene {scan} has {bad_file_count} bad frame files out of {color_file_count}.")
+
+    return frame_ids, dists_to_last_valid_frame
+
+
+def _finalize_depth(depth, scale, max_depth=None):
+    """Scales a loaded depth map, computes its validity mask, and places NaNs
+    where depth is invalid.
+
+    The scaled float32 depth is written in a single pass and both outputs are
+    wrapped with torch.from_numpy, so no extra full size copies are made.
+
+    Args:
+        depth: (H, W) depth map at the precision it was stored at.
+        scale: factor to multiply stored depth values by.
+        max_depth: if not None, depth is only valid where it's also below
+            this stored value. Depth is always only valid where it's
+            positive.
+
+    Returns:
+        depth: (1, H, W) float32 depth tensor with NaNs where invalid.
+        mask: (1, H, W) float validity mask (1.0 where depth is valid).
+        mask_b: like mask but boolean.
+    """
+    mask_b = depth > 0
+    if max_depth is not None:
+        mask_b &= depth < max_depth
+
+    # upcast to float32 while scaling, in case depth is stored as float16.
+    depth = np.multiply(depth, scale, dtype=np.float32)
+    np.copyto(depth, np.nan, where=~mask_b)
+
+    mask_b = torch.from_numpy(mask_b).unsqueeze(0)
+    depth = torch.from_numpy(depth).unsqueeze(0)
+
+    return depth, mask_b.float(), mask_b
+
+
+def _invalid_depth(height, width):
+    """Returns an all invalid depth map, float mask and boolean mask, for
+    frames without a depth file."""
+    depth = torch.full((1, height, width), torch.nan)
+    mask = torch.zeros((1, height, width))
+    mask_b = torch.zeros((1, height, width), dtype=torch.bool)
+
+    return depth, mask, mask_b
+
+
+def _linear_quantile(values, q):
+    """Computes np.quantile(values, q) with its default linear interpolation,
+    using np.partition instead of a full sort.
+
+    Args:
+        values: 1D array of values.
+        q: quantile to compute, in [0, 1].
+
+    Returns:
+        The q-th quantile of values as a float.
+    """
+    position = q * (values.size - 1)
+    lower = int(position)
+    upper = min(lower + 1, values.size - 1)
+
+    partitioned = np.partition(values, (lower, upper))
+    lower_value = float(partitioned[lower])
+
+    return lower_value + (float(partitioned[upper]) - lower_value) * (position - lower)
+
+
+def _quantize_depth_u16(depth):
+    """Rounds a depth map to the nearest stored unit and stores it as uint16.
+
+    Invalid (nan or negative) depth is stored as 0 and values beyond the
+    uint16 range are clamped to 65535. uint16 depth maps are returned as is.
+    """
+    if depth.dtype == np.uint16:
+        return depth
+
+    depth = np.nan_to_num(depth.astype(np.float32), nan=0.0, posinf=65535.0, neginf=0.0)
+    return np.clip(np.rint(depth), 0, 65535).astype(np.uint16)
+
+
+def finalize_deferred_depth(data):
+    """Builds depth and its masks for a batch from a WAIDataset with
+    defer_depth_finalization=True.
+
+    Meant to run on the GPU after the batch has been transferred. data's
+    depth_b1hw holds uint16 stored depth viewed as int16 (torch has no
+    uint16 tensors), which is replaced by scaled float depth with NaNs where
+    depth is invalid, and mask_b1hw, mask_b_b1hw, and skymask_b1hw are
+    added, as GenericMVSDataset.get_frame would have returned them.
+
+    Args:
+        data: a batch dict with "depth_b1hw" and "depth_scale", updated in
+            place.
+
+    Returns:
+        data: the updated batch dict.
+    """
+    # undo the int16 view, then 0 marks invalid depth.
+    depth_b1hw = data["depth_b1hw"].int().bitwise_and_(0xFFFF)
+    mask_b_b1hw = depth_b1hw > 0
+
+    depth_b1hw = depth_b1hw.float()
+    depth_b1hw.mul_(data["depth_scale"].to(depth_b1hw).view(-1, 1, 1, 1))
+    depth_b1hw.masked_fill_(~mask_b_b1hw, torch.nan)
+
+    mask_b1hw = mask_b_b1hw.float()
+    data.update(
+        {
+            "depth_b1hw": depth_b1hw,
+            "mask_b1hw": mask_b1hw,
+            "mask_b_b1hw": mask_b_b1hw,
+            "skymask_b1hw": torch.full_like(mask_b1hw, torch.nan),
+        }
+    )
+
+    return data
+
+
+def _intrinsics_to_tensors(f_x, f_y, c_x, c_y):
+    """Builds a 4x4 pinhole intrinsics matrix and its inverse.
+
+    The inverse of a pinhole intrinsics matrix is known in closed form, so
+    there's no need for a general matrix inverse.
+
+    Returns:
+        K: 4x4 float32 intrinsics tensor.
+        invK: 4x4 float32 tensor, the inverse of K.
+    """
+    K = np.array(
+        [
+            [f_x, 0, c_x, 0],
+            [0, f_y, c_y, 0],
+            [0, 0, 1, 0],
+            [0, 0, 0, 1],
+        ],
+        dtype=np.float32,
+    )
+    invK = np.array(
+        [
+            [1.0 / f_x, 0, -c_x / f_x, 0],
+            [0, 1.0 / f_y, -c_y / f_y, 0],
+            [0, 0, 1, 0],
+            [0, 0, 0, 1],
+        ],
+        dtype=np.float32,
+    )
+
+    return torch.from_numpy(K), torch.from_numpy(invK)
+
 
 class WAIDataset(GenericMVSDataset):
     """
@@ -51,6 +341,9 @@ class WAIDataset(GenericMVSDataset):
         native_depth_width=480,
         native_depth_height=640,
         depth_mode="rendered_depth",
+        cache_resized_depth=False,
+        cache_scene_meta=False,
+        defer_depth_finalization=False,
     ):
         super().__init__(
             dataset_path=dataset_path,
@@ -115,12 +408,46 @@ class WAIDataset(GenericMVSDataset):
                 initialization.
             min_valid_depth, max_valid_depth: values to generate a validity mask
                 for depth maps.
+            depth_mode: folder in each scan that depth maps are read from.
+            cache_resized_depth: if True, depth maps resized to the dataset's
+                depth resolution are stored in each scan and loaded from
+                there on later reads. See get_cached_depth_filepath. Off by
+                default since it writes into the dataset folder.
+            cache_scene_meta: if True, processed scene metadata is pickled
+                next to each scene_meta.json and read from there on later
+                loads. See _load_scene_meta. Off by default for the same
+                reason.
+            defer_depth_finalization: if True, the reference frame's
+                depth_b1hw is returned as uint16 stored depth (viewed as
+                int16) without masks, so scaling and building masks can be
+                done on the GPU after the batch is transferred. Depth maps
+                that aren't uint16 (see convert_wai_depth_to_u16.py) are
+                rounded to uint16 on load. Batches then carry a
+                "depth_scale" entry and must go through
+                finalize_deferred_depth before use. Only for loaders that
+                serve WAIDataset batches alone.
         
         """
         self.native_depth_height = native_depth_height
         self.native_depth_width = native_depth_width
-        self.capture_metadata = {}
         self.depth_mode = depth_mode
+        self.cache_resized_depth = cache_resized_depth
+        self.cache_scene_meta = cache_scene_meta
+        self.defer_depth_finalization = defer_depth_finalization
+
+        # depth folder listings per scan, see get_depth_filenames.
+        self.depth_filenames = {}
+
+        # warm the metadata cache and depth folder listings for every scan in
+        # the tuple file so that DataLoader workers inherit them when they
+        # fork, instead of each worker parsing the same scene_meta.json files.
+        if mv_tuple_file_suffix is not None:
+            scan_ids = dict.fromkeys(
+                frame_tuple.split(" ")[0] for frame_tuple in self.frame_tuples
+            )
+            for scan_id in scan_ids:
+                self.load_capture_metadata(scan_id)
+                self.get_depth_filenames(scan_id)
 
     def get_frame_id_string(self, frame_id):
         """Returns an id string for this frame_id that's unique to this frame
@@ -147,9 +474,7 @@ class WAIDataset(GenericMVSDataset):
         return os.path.join(str(scan_dir), "valid_frames.txt")
 
     def _get_frame_ids(self, split, scan):
-        with open(self.dataset_path / scan / "scene_meta.json") as f:
-            data = json.load(f)
-        frame_ids = [frame_data["file_path"] for frame_data in data["frames"]]
+        frame_ids = list(self.load_capture_metadata(scan)["frames"].keys())
 
         return frame_ids
 
@@ -171,62 +496,137 @@ class WAIDataset(GenericMVSDataset):
 
         Returns:
             valid_frames: a list of strings with info on valid frames.
-            Each string is a concat of the scan_id and the frame_id.
+            Each string is a concat of the scan_id, the frame_id, and the
+            distance to the last valid frame when that is known.
         """
         scan = scan.rstrip("\n")
-        if store_computed:
-            valid_frame_path = self.get_valid_frame_path(split, scan)
-        else:
-            valid_frame_path = ""
+        frame_ids, dists_to_last_valid_frame = self.get_valid_frame_arrays(
+            split, scan, store_computed=store_computed
+        )
+
+        # unknown distances (from old valid_frames.txt files) are left out,
+        # which is what tuple_generator expects for them.
+        return [
+            f"{scan} {frame_id} {dist}" if dist >= 0 else f"{scan} {frame_id}"
+            for frame_id, dist in zip(frame_ids.tolist(), dists_to_last_valid_frame.tolist())
+        ]
+
+    def get_valid_frame_arrays(self, split, scan, store_computed=False):
+        """Either loads or computes the ids of valid frames for a scan, as
+        aligned arrays. See get_valid_frame_ids for what a valid frame is.
+
+        Existing valid frame files (e.g. from precompute_valid_frames) are
+        always read. Computed arrays are stored as valid_frames.npz next to
+        valid_frames.txt when store_computed is set. The npz file is only
+        read when it's at least as new as valid_frames.txt, so a deleted
+        or hand edited txt isn't shadowed by a stale npz.
+
+        Args:
+            split: the data split (train/val/test)
+            scan: the name of the scan
+            store_computed: store computed valid frames where we'd expect
+            to see them. If the files can't be saved, a warning will be
+            printed and the exception reason printed.
+
+        Returns:
+            frame_ids: string array of valid frame ids.
+            dists_to_last_valid_frame: int32 array with the number of invalid
+                frames between each valid frame and the valid frame before it.
+                -1 where that isn't known, i.e. for lines in an older
+                valid_frames.txt without a distance column.
+        """
+        scan = scan.rstrip("\n")
+        valid_frame_path = self.get_valid_frame_path(split, scan)
+        valid_frame_array_path = os.path.splitext(valid_frame_path)[0] + ".npz"
+
+        # the npz is only valid alongside the txt it was stored with.
+        if (
+            os.path.exists(valid_frame_array_path)
+            and os.path.exists(valid_frame_path)
+            and os.path.getmtime(valid_frame_array_path) >= os.path.getmtime(valid_frame_path)
+        ):
+            with np.load(valid_frame_array_path) as valid_frame_arrays:
+                return (
+                    valid_frame_arrays["frame_ids"],
+                    valid_frame_arrays["dists_to_last_valid_frame"],
+                )
 
         if os.path.exists(valid_frame_path):
             # valid frame file exists, read that to find the ids of frames with
-            # valid poses.
+            # valid poses. Each line is "scan_id frame_id dist", older files
+            # don't have the dist column.
             with open(valid_frame_path) as f:
-                valid_frames = f.readlines()
-        else:
-            print(f"Computing valid frames for scene {scan}.")
-            # find out which frames have valid poses
-
-            # load scan metadata
-            self.load_capture_metadata(scan)
-            color_file_count = len(self.capture_metadata[scan]["frames"])
-
-            valid_frames = []
-            dist_to_last_valid_frame = 0
-            bad_file_count = 0
-
-            for frame_ind in self.capture_metadata[scan]["frames"]:
-                world_T_cam_44, _ = self.load_pose(scan, frame_ind)
-                if (
-                    np.isnan(np.sum(world_T_cam_44))
-                    or np.isinf(np.sum(world_T_cam_44))
-                    or np.isneginf(np.sum(world_T_cam_44))
-                ):
-                    bad_file_count += 1
-                    dist_to_last_valid_frame += 1
-                    continue
-
-                valid_frames.append(f"{scan} {frame_ind} {dist_to_last_valid_frame}")
-                dist_to_last_valid_frame = 0
-
-            print(
-                f"Scene {scan} has {bad_file_count} bad frame files out of "
-                f"{color_file_count}."
+                valid_frames = [line.split() for line in f.read().splitlines() if line.strip()]
+
+            frame_ids = np.array([valid_frame[1] for valid_frame in valid_frames], dtype=str)
+            dists_to_last_valid_frame = np.array(
+                [valid_frame[2] if len(valid_frame) > 2 else -1 for valid_frame in valid_frames],
+                dtype=np.int32,
             )
 
-            # store computed if we're being asked, but wrapped inside a try
-            # incase this directory is read only.
-            if store_computed:
-                # store those files to valid_frames.txt
-                try:
-                    with open(valid_frame_path, "w") as f:
-                        f.write("\n".join(valid_frames) + "\n")
-                except Exception as e:
-                    print(f"Couldn't save valid_frames at {valid_frame_path}, cause:")
-                    print(e)
+            return frame_ids, dists_to_last_valid_frame
 
-        return valid_frames
+        frame_ids, dists_to_last_valid_frame = _compute_valid_frames(
+            scan, self.get_metadata_path(scan), self.cache_scene_meta
+        )
+
+        if store_computed:
+            self._store_valid_frames(split, scan, frame_ids, dists_to_last_valid_frame)
+
+        return frame_ids, dists_to_last_valid_frame
+
+    def _store_valid_frames(self, split, scan, frame_ids, dists_to_last_valid_frame):
+        """Stores computed valid frames as valid_frames.txt for tools that
+        read it directly, and as valid_frames.npz. The npz is written last so
+        it's at least as new as the txt. Wrapped inside a try incase this
+        directory is read only."""
+        valid_frame_path = self.get_valid_frame_path(split, scan)
+        valid_frame_array_path = os.path.splitext(valid_frame_path)[0] + ".npz"
+
+        try:
+            with open(valid_frame_path, "w") as f:
+                f.writelines(
+                    f"{scan} {frame_id} {dist}\n"
+                    for frame_id, dist in zip(frame_ids, dists_to_last_valid_frame)
+                )
+            np.savez(
+                valid_frame_array_path,
+                frame_ids=frame_ids,
+                dists_to_last_valid_frame=dists_to_last_valid_frame,
+            )
+        except Exception as e:
+            print(f"Couldn't save valid_frames at {valid_frame_path}, cause:")
+            print(e)
+
+    def precompute_valid_frames(self, split, scans, num_workers=None):
+        """Computes and stores valid frames for many scans in parallel.
+
+        Scans that already have a valid_frames.txt are skipped, since
+        get_valid_frame_arrays reads that directly. Each scan is computed in
+        its own process, see _compute_valid_frames.
+
+        Args:
+            split: the data split (train/val/test)
+            scans: names of the scans to compute valid frames for.
+            num_workers: number of processes to use, defaults to the number
+                of CPUs.
+        """
+        scans = [scan.rstrip("\n") for scan in scans]
+        scans = [
+            scan
+            for scan in scans
+            if not os.path.exists(self.get_valid_frame_path(split, scan))
+        ]
+
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            results = executor.map(
+                _compute_valid_frames,
+                scans,
+                [self.get_metadata_path(scan) for scan in scans],
+                [self.cache_scene_meta] * len(scans),
+            )
+            for scan, (frame_ids, dists_to_last_valid_frame) in zip(scans, results):
+                self._store_valid_frames(split, scan, frame_ids, dists_to_last_valid_frame)
 
     def load_pose(self, scan_id, frame_id):
         """Loads a frame's pose file.
@@ -243,24 +643,22 @@ class WAIDataset(GenericMVSDataset):
 
         """
 
-        self.load_capture_metadata(scan_id)
-        frame_metadata = self.capture_metadata[scan_id]["frames"][frame_id]
-
-        world_T_cam = torch.tensor(
-            frame_metadata["transform_matrix"], dtype=torch.float32
-        ).view(4, 4)
+        capture_metadata = self.load_capture_metadata(scan_id)
+        frame_metadata = capture_metadata["frames"][frame_id]
 
-        gl_to_cv = torch.FloatTensor(
-            [[1, -1, -1, 1], [-1, 1, 1, -1], [-1, 1, 1, -1], [1, 1, 1, 1]]
-        )
+        world_T_cam = np.array(
+            frame_metadata["transform_matrix"], dtype=np.float32
+        ).reshape(4, 4)
 
-        if (
-            self.capture_metadata[scan_id]["frames"] == "opengl"
-        ):  # TODO: only opencv is allowed on wai
-            world_T_cam *= gl_to_cv
-        world_T_cam = world_T_cam.numpy()
+        # WAI poses are opencv, but convert any scene that says otherwise.
+        if capture_metadata.get("camera_convention") == "opengl":
+            np.multiply(world_T_cam, _GL_TO_CV, out=world_T_cam)
 
-        cam_T_world = np.linalg.inv(world_T_cam)
+        # poses are rigid, so invert them in closed form: [R^T | -R^T t]
+        R_T = world_T_cam[:3, :3].T
+        cam_T_world = np.eye(4, dtype=np.float32)
+        cam_T_world[:3, :3] = R_T
+        cam_T_world[:3, 3] = -R_T @ world_T_cam[:3, 3]
 
         return world_T_cam, cam_T_world
 
@@ -286,8 +684,7 @@ class WAIDataset(GenericMVSDataset):
         """
         output_dict = {}
 
-        self.load_capture_metadata(scan_id)
-        json_data = self.capture_metadata[scan_id]
+        json_data = self.load_capture_metadata(scan_id)
         frame_data = json_data["frames"][frame_id]
 
         width_pixels = frame_data["w"] if "w" in frame_data else json_data["w"]
@@ -300,85 +697,78 @@ class WAIDataset(GenericMVSDataset):
         if flip:
             c_x = width_pixels - c_x
 
-        # Construct the intrinsic matrix in pixel coordinates
-        K = torch.eye(4, dtype=torch.float32)
-        K[:3, :3] = torch.tensor(
-            [[f_x, 0, c_x], [0, f_y, c_y], [0, 0, 1]], dtype=torch.float32
-        )
+        # Scale intrinsics to the matching and depth resolutions. Intrinsics
+        # are built and inverted in closed form, see _intrinsics_to_tensors.
+        matching_x_scale = self.matching_width / float(width_pixels)
+        matching_y_scale = self.matching_height / float(height_pixels)
+        f_x_matching, c_x_matching = f_x * matching_x_scale, c_x * matching_x_scale
+        f_y_matching, c_y_matching = f_y * matching_y_scale, c_y * matching_y_scale
 
-        K_matching = K.clone()
-        K_matching[0] *= self.matching_width / float(width_pixels)
-        K_matching[1] *= self.matching_height / float(height_pixels)
-
-        K_depth = K.clone()
-        K_depth[0] *= self.depth_width / float(width_pixels)
-        K_depth[1] *= self.depth_height / float(height_pixels)
+        depth_x_scale = self.depth_width / float(width_pixels)
+        depth_y_scale = self.depth_height / float(height_pixels)
+        f_x_depth, c_x_depth = f_x * depth_x_scale, c_x * depth_x_scale
+        f_y_depth, c_y_depth = f_y * depth_y_scale, c_y * depth_y_scale
 
         if self.rotate_images:
-            temp = K.clone()
-            K[0, 0] = temp[1, 1]
-            K[1, 1] = temp[0, 0]
-            K[1, 2] = temp[0, 2]
-            K[0, 2] = self.depth_height - temp[1, 2]
-
-            matching_temp = K_matching.clone()
-            K_matching[0, 0] = matching_temp[1, 1]
-            K_matching[1, 1] = matching_temp[0, 0]
-            K_matching[1, 2] = matching_temp[0, 2]
-            K_matching[0, 2] = self.matching_height - matching_temp[1, 2]
+            f_x_matching, f_y_matching, c_x_matching, c_y_matching = (
+                f_y_matching,
+                f_x_matching,
+                self.matching_height - c_y_matching,
+                c_x_matching,
+            )
 
-        output_dict["K_matching_b44"] = K_matching
-        output_dict["invK_matching_b44"] = torch.linalg.inv(K_matching)
+        (
+            output_dict["K_matching_b44"],
+            output_dict["invK_matching_b44"],
+        ) = _intrinsics_to_tensors(f_x_matching, f_y_matching, c_x_matching, c_y_matching)
 
         # optionally include the intrinsics matrix for the full res depth map.
         if self.include_full_depth_K:
-            output_dict["K_full_depth_b44"] = K_depth.clone()
-            output_dict["invK_full_depth_b44"] = torch.linalg.inv(K_depth)
+            (
+                output_dict["K_full_depth_b44"],
+                output_dict["invK_full_depth_b44"],
+            ) = _intrinsics_to_tensors(f_x_depth, f_y_depth, c_x_depth, c_y_depth)
 
         # Get the intrinsics of all scales at various resolutions.
         for i in range(self.prediction_num_scales):
-            K_scaled = K_depth.clone()
-            K_scaled[0, 0] /= 2**i
-            K_scaled[1, 1] /= 2**i
-            K_scaled[0, 2] /= 2**i
-            K_scaled[1, 2] /= 2**i
-            output_dict[f"K_s{i}_b44"] = K_scaled
-            output_dict[f"invK_s{i}_b44"] = torch.linalg.inv(K_scaled)
+            scale = 1.0 / 2**i
+            (
+                output_dict[f"K_s{i}_b44"],
+                output_dict[f"invK_s{i}_b44"],
+            ) = _intrinsics_to_tensors(
+                f_x_depth * scale,
+                f_y_depth * scale,
+                c_x_depth * scale,
+                c_y_depth * scale,
+            )
 
         return output_dict, None
 
     def load_capture_metadata(self, scan_id):
-        """Reads a nerfstudio scene_meta file and loads metadata for that scan into
-        self.capture_metadata
+        """Reads a nerfstudio scene_meta file and returns the metadata for that
+        scan.
 
         It does this by loading a metadata json file that contains frame
         RGB information, intrinsics, and poses for each frame.
 
-        Metadata for each scan is cached in the dictionary
-        self.capture_metadata.
+        Metadata isn't kept on the dataset. It's cached by _load_scene_meta,
+        an unbounded cache shared by every dataset instance in the process,
+        which with cache_scene_meta also keeps an on disk pickle of the
+        processed metadata next to scene_meta.json.
 
         Args:
             scan_id: a scan_id whose metadata will be read.
-        """
-        if scan_id in self.capture_metadata:
-            return
-
-        metadata_path = os.path.join(
-            self.dataset_path,
-            self.get_sub_folder_dir(self.split),
-            scan_id,
-            "scene_meta.json",
-        )
-
-        with open(metadata_path) as f:
-            capture_metadata = json.load(f)
 
-        frame_data = {}
-        for frame in capture_metadata["frames"]:
-            frame_data[frame["file_path"]] = frame
+        Returns:
+            capture_metadata: the scan's metadata, where "frames" is a dict
+                from a frame's file_path to that frame's metadata. Shared
+                between callers, so it must not be modified.
+        """
+        return _load_scene_meta(self.get_metadata_path(scan_id), self.cache_scene_meta)
 
-        self.capture_metadata[scan_id] = capture_metadata
-        self.capture_metadata[scan_id]["frames"] = frame_data
+    def get_metadata_path(self, scan_id):
+        """returns the filepath of a scan's scene_meta.json file."""
+        return os.path.join(self.scenes_path, scan_id, "scene_meta.json")
 
     def get_cached_depth_filepath(self, scan_id, frame_id):
         """returns the filepath for a frame's depth file at the dataset's
@@ -389,12 +779,38 @@ class WAIDataset(GenericMVSDataset):
             frame_id: id for the frame.
 
         Returns:
-            Either the filepath for a precached depth file at the size
-            required, or if that doesn't exist, the full size depth frame
-            from the dataset.
+            Filepath for a precached depth file at the size required. These
+            are written by load_target_size_depth_and_mask the first time a
+            frame's depth is resized, and are only used while they are newer
+            than the full res depth file.
 
         """
-        return ""
+        return os.path.join(
+            self.dataset_path,
+            scan_id,
+            f"{self.depth_mode}_cache_{self.depth_width}x{self.depth_height}",
+            frame_id.split("/")[-1][:-3] + "npy",
+        )
+
+    def _store_cached_depth(self, cached_depth_filepath, depth):
+        """Stores a resized depth map at cached_depth_filepath so later loads
+        can skip decoding and resizing.
+
+        The file is written to a temp file first so concurrent workers never
+        read a partial file. If the file can't be saved, e.g. the dataset is
+        read only, a warning is printed and caching is disabled.
+        """
+        try:
+            os.makedirs(os.path.dirname(cached_depth_filepath), exist_ok=True)
+            temp_path = f"{cached_depth_filepath}.{os.getpid()}.tmp"
+            with open(temp_path, "wb") as f:
+                np.save(f, depth)
+            os.replace(temp_path, cached_depth_filepath)
+        except Exception as e:
+            print(f"Couldn't save cached depth at {cached_depth_filepath}, cause:")
+            print(e)
+            print("Disabling resized depth caching.")
+            self.cache_resized_depth = False
 
     def get_cached_confidence_filepath(self, scan_id, frame_id, crop=None):
         """returns the filepath for a frame's depth confidence file at the
@@ -426,16 +842,37 @@ class WAIDataset(GenericMVSDataset):
             from the dataset.
 
         """
+        # prefer uint16 depth from scripts/data_scripts/convert_wai_depth_to_u16.py
+        depth_filenames = self.get_depth_filenames(scan_id)
+        depth_filename_stem = frame_id.split("/")[-1][:-3]
+        for extension in ("npy", "exr"):
+            depth_filename = depth_filename_stem + extension
+            if depth_filename in depth_filenames:
+                return os.path.join(self.dataset_path, scan_id, self.depth_mode, depth_filename)
 
-        path = (
-            Path(self.dataset_path)
-            / Path(scan_id)
-            / Path(self.depth_mode)
-            / Path(frame_id.split("/")[-1][:-3] + "exr")
-        )
+        return None
+
+    def get_depth_filenames(self, scan_id):
+        """Returns the names of the files in a scan's depth folder.
 
-        return str(path) if path.exists() else None
-        # return str(path)
+        The folder is listed once per scan and kept in self.depth_filenames,
+        so checking if a frame has depth doesn't need a stat per frame.
+
+        Args:
+            scan_id: the scan whose depth folder to list.
+
+        Returns:
+            A frozenset of filenames, empty if the scan has no depth folder.
+        """
+        if scan_id not in self.depth_filenames:
+            depth_dir = os.path.join(self.dataset_path, scan_id, self.depth_mode)
+            try:
+                with os.scandir(depth_dir) as entries:
+                    self.depth_filenames[scan_id] = frozenset(entry.name for entry in entries)
+            except FileNotFoundError:
+                self.depth_filenames[scan_id] = frozenset()
+
+        return self.depth_filenames[scan_id]
 
     def get_full_res_confidence_filepath(self, scan_id, frame_id):
         """returns the filepath for a frame's depth confidence file at the
@@ -474,44 +911,95 @@ class WAIDataset(GenericMVSDataset):
         if (
             full_res_depth_filepath == None
         ):  # no depth file found, returns tensor of nans according to nerfstudio_dataset logic
-            full_res_depth = torch.zeros(1, self.depth_height, self.depth_width)
-            full_res_depth[:] = torch.nan
-            full_res_mask = torch.zeros_like(full_res_depth)
-            full_res_mask_b = torch.zeros_like(full_res_depth).bool()
-
-            return full_res_depth, full_res_mask, full_res_mask_b
+            return _invalid_depth(self.depth_height, self.depth_width)
 
         full_res_depth = self._load_depth(full_res_depth_filepath)
-        image = cv2.imread(
-            full_res_depth_filepath, cv2.IMREAD_ANYCOLOR | cv2.IMREAD_ANYDEPTH
-        )
 
-        if "street" in scan_id and (full_res_depth < 65000).any():
-            full_res_mask_b = full_res_depth < np.quantile(
-                full_res_depth[full_res_depth < 65000], 0.95
-            )
-        else:
-            full_res_mask_b = full_res_depth > 0
-        full_res_mask_b = torch.tensor(full_res_mask_b).bool().unsqueeze(0)
+        # full res depth isn't scaled by 1/100, matrix city artefact. Stored
+        # values are relative to the 0.01 scale of the EXR depth maps, so
+        # scans with another depth_scale are rescaled to match, as is the
+        # sky cutoff below (which is in stored units).
+        scale = self.get_depth_scale(scan_id) / 0.01
 
-        # full_res_depth = torch.tensor(full_res_depth / 100).float().unsqueeze(0) # matrix city artefact
-        full_res_depth = (
-            torch.tensor(full_res_depth).float().unsqueeze(0)
-        )  # matrix city artefact
+        max_depth = None
+        if "street" in scan_id:
+            # 0 is invalid depth in converted scans, like NaN in EXRs.
+            finite_depth = full_res_depth[
+                (full_res_depth > 0) & (full_res_depth < 65000 / scale)
+            ]
+            if finite_depth.size > 0:
+                max_depth = _linear_quantile(finite_depth, 0.95)
 
-        # # Get the float valid mask
-        full_res_mask = full_res_mask_b.float()
+        return _finalize_depth(full_res_depth, scale=scale, max_depth=max_depth)
 
-        # set invalids to nan
-        full_res_depth[~full_res_mask_b] = torch.tensor(np.nan)
+    @staticmethod
+    def _load_exr_depth(depth_path):
+        """Reads the depth channel of an EXR file with OpenEXR, keeping the
+        stored pixel type (e.g. float16 for half EXRs).
 
-        return full_res_depth, full_res_mask, full_res_mask_b
+        The depth channel is "Y" or "Z", or the file's only channel. Raises a
+        KeyError for files where it's ambiguous (e.g. RGBA) so the caller
+        falls back to OpenCV.
+        """
+        exr_file = OpenEXR.InputFile(depth_path)
+        try:
+            header = exr_file.header()
+
+            data_window = header["dataWindow"]
+            width = data_window.max.x - data_window.min.x + 1
+            height = data_window.max.y - data_window.min.y + 1
+
+            channels = header["channels"]
+            if "Y" in channels:
+                channel_name = "Y"
+            elif "Z" in channels:
+                channel_name = "Z"
+            elif len(channels) == 1:
+                channel_name = next(iter(channels))
+            else:
+                raise KeyError(
+                    f"No depth channel in {depth_path}, channels: {sorted(channels)}"
+                )
+
+            pixel_type = channels[channel_name].type
+            dtype = {
+                Imath.PixelType.HALF: np.float16,
+                Imath.PixelType.FLOAT: np.float32,
+                Imath.PixelType.UINT: np.uint32,
+            }[pixel_type.v]
+
+            depth = np.frombuffer(exr_file.channel(channel_name, pixel_type), dtype=dtype)
+        finally:
+            exr_file.close()
+
+        return depth.reshape(height, width)
 
     @staticmethod
     def _load_depth(depth_path):
+        if depth_path.endswith(".npy"):
+            return np.load(depth_path, mmap_mode="r")
+
+        depth_dir = os.path.dirname(depth_path)
+        if (
+            OpenEXR is not None
+            and depth_path.endswith(".exr")
+            and depth_dir not in _OPENEXR_FAILED_DIRS
+        ):
+            try:
+                return WAIDataset._load_exr_depth(depth_path)
+            except (OSError, KeyError) as e:
+                print(
+                    f"Couldn't read {depth_path} with OpenEXR, using OpenCV for "
+                    f"{depth_dir} from now on, cause:"
+                )
+                print(e)
+                _OPENEXR_FAILED_DIRS.add(depth_dir)
+
         try:
             image = cv2.imread(depth_path, cv2.IMREAD_ANYCOLOR | cv2.IMREAD_ANYDEPTH)
-        except:
+        except cv2.error as e:
+            print(f"Couldn't read depth at {depth_path}, cause:")
+            print(e)
             image = np.zeros((1000, 1000))
 
         return image
@@ -535,45 +1023,130 @@ class WAIDataset(GenericMVSDataset):
             is valid).
             mask_b: like mask but boolean.
         """
-        depth_filepath = self.get_full_res_depth_filepath(scan_id, frame_id)
+        depth = self._load_target_size_depth(scan_id, frame_id, crop)
 
         if (
-            depth_filepath == None
+            depth is None
         ):  # # no depth file found, returns tensor of nans according to nerfstudio_dataset logic
-            depth = torch.zeros(1, self.depth_height, self.depth_width)
-            depth[:] = torch.nan
-            mask = torch.zeros_like(depth)
-            mask_b = torch.zeros_like(depth).bool()
+            return _invalid_depth(self.depth_height, self.depth_width)
 
-            return depth, mask, mask_b
+        depth, mask, mask_b = _finalize_depth(depth, scale=self.get_depth_scale(scan_id))
 
-        depth = self._load_depth(depth_filepath)
+        if mask.sum() == 0:
+            print("0")
 
-        if crop:
-            depth = depth[crop[1] : crop[3], crop[0] : crop[2]]
+        return depth, mask, mask_b
 
-        depth = cv2.resize(
-            depth,
-            dsize=(self.depth_width, self.depth_height),
-            interpolation=cv2.INTER_NEAREST,
-        )
+    def _load_target_size_depth(self, scan_id, frame_id, crop=None):
+        """Loads a frame's depth at the target resolution, in stored units
+        and at the precision it's stored at. Returns None if the frame has no
+        depth file."""
+        depth_filepath = self.get_full_res_depth_filepath(scan_id, frame_id)
 
-        mask_b = depth > 0
+        if depth_filepath is None:
+            return None
+
+        # resized depth maps are cached on disk, crops can't use the cache.
+        # A cached file is only used if it's at least as new as the full res
+        # depth file, so regenerated depth maps aren't shadowed by stale ones.
+        cached_depth_filepath = self.get_cached_depth_filepath(scan_id, frame_id)
+        use_cache = self.cache_resized_depth and not crop
+
+        cache_is_fresh = False
+        if use_cache:
+            try:
+                cache_is_fresh = (
+                    os.path.getmtime(cached_depth_filepath)
+                    >= os.path.getmtime(depth_filepath)
+                )
+            except OSError:
+                pass
+
+        if cache_is_fresh:
+            depth = np.load(cached_depth_filepath, mmap_mode="r")
+        else:
+            depth = self._load_depth(depth_filepath)
+
+            if crop:
+                depth = depth[crop[1] : crop[3], crop[0] : crop[2]]
+
+            # depth maps that are already at the target size don't need
+            # resizing. An .npy at the target size is already as cheap to
+            # load as its cached copy would be, so it isn't cached.
+            if depth.shape[:2] != (self.depth_height, self.depth_width):
+                depth = cv2.resize(
+                    depth,
+                    dsize=(self.depth_width, self.depth_height),
+                    interpolation=cv2.INTER_NEAREST,
+                )
+            elif depth_filepath.endswith(".npy"):
+                use_cache = False
+
+            if use_cache:
+                self._store_cached_depth(cached_depth_filepath, depth)
+
+        return depth
+
+    def get_depth_scale(self, scan_id):
+        """Returns the factor that converts a scan's stored depth values to
+        the depth returned by load_target_size_depth_and_mask.
+
+        This is read from the "depth_scale" entry in scene_meta.json, and
+        defaults to 0.01 for the EXR depth maps.
+        """
+        return self.load_capture_metadata(scan_id).get("depth_scale", 0.01)
 
-        mask_b = torch.tensor(mask_b).bool().unsqueeze(0)
+    def get_frame(self, scan_id, frame_id, load_depth, flip=False):
+        """Retrieves a single frame's data, see GenericMVSDataset.get_frame.
 
-        depth = torch.tensor(depth / 100).float().unsqueeze(0)
+        When depth finalization is deferred, depth is loaded here instead.
+        depth_b1hw is uint16 stored depth viewed as int16 and the masks are
+        left to finalize_deferred_depth. min_depth and max_depth are computed
+        from the stored depth, and the scan's depth scale is passed along as
+        "depth_scale".
+        """
+        if not (load_depth and self.defer_depth_finalization):
+            return super().get_frame(scan_id, frame_id, load_depth, flip=flip)
 
-        # # Get the float valid mask
-        mask = mask_b.float()
+        output_dict = super().get_frame(scan_id, frame_id, load_depth=False, flip=flip)
 
-        if mask.sum() == 0:
-            print("0")
+        depth = self._load_target_size_depth(scan_id, frame_id)
+        if depth is None:
+            depth = np.zeros((self.depth_height, self.depth_width), dtype=np.uint16)
+        else:
+            # copies, so depth is writable even when it's memory mapped.
+            depth = np.array(_quantize_depth_u16(depth))
 
-        # set invalids to nan
-        depth[~mask_b] = torch.tensor(np.nan)
+        depth_scale = self.get_depth_scale(scan_id)
 
-        return depth, mask, mask_b
+        # 0 marks invalid depth, so the max is over valid depth already.
+        max_value = depth.max()
+        if max_value > 0:
+            min_value = np.min(depth, where=depth > 0, initial=max_value)
+            max_depth = torch.tensor(float(max_value) * depth_scale)
+            min_depth = torch.tensor(float(min_value) * depth_scale)
+        else:
+            max_depth = torch.tensor(10.0)
+            min_depth = torch.tensor(10.0)
+
+        depth = torch.from_numpy(depth.view(np.int16)).unsqueeze(0)
+
+        if self.rotate_images:
+            depth = torch.rot90(depth, 3, [1, 2])
+
+        if flip:
+            depth = torch.flip(depth, (-1,))
+
+        output_dict.update(
+            {
+                "depth_b1hw": depth,
+                "max_depth": max_depth * (torch.rand(1)[0] + 1.0),
+                "min_depth": min_depth * (torch.rand(1)[0] * 0.5 + 0.5),
+                "depth_scale": torch.tensor(depth_scale, dtype=torch.float32),
+            }
+        )
+
+        return output_dict
 
     def get_color_filepath(self, scan_id, frame_id):
         """returns the filepath for a frame's color file at the dataset's
@@ -589,13 +1162,10 @@ class WAIDataset(GenericMVSDataset):
             from the dataset.
 
         """
-        scene_path = os.path.join(
-            self.dataset_path, self.get_sub_folder_dir(self.split), scan_id
-        )
-        image_path = os.path.join(scene_path, frame_id)
+        image_path = os.path.join(self.scenes_path, scan_id, frame_id)
 
         # Check if suffix is empty
-        if Path(image_path).suffix == "":
+        if not os.path.splitext(image_path)[1]:
             # Add the suffix to the image path
             image_path += ".png"
 
@@ -617,3 +1187,97 @@ class WAIDataset(GenericMVSDataset):
         """
 
         return self.get_color_filepath(scan_id, frame_id)
+
+
+class WAIPrefetcher:
+    """
+    Wraps a DataLoader of WAIDataset batches and copies the next batch to the
+    GPU on a side CUDA stream while the current batch is being used, so host
+    to device copies overlap with the model's forward and backward passes.
+
+    If the dataset was created with defer_depth_finalization=True, depth is
+    also scaled and its masks built on the side stream, see
+    finalize_deferred_depth.
+
+    The DataLoader should be created with pin_memory=True, otherwise the
+    non_blocking copies are synchronous, and with persistent_workers=True so
+    workers aren't restarted between epochs.
+
+    Usage:
+        for cur_data, src_data in WAIPrefetcher(dataloader):
+            ...
+
+    """
+
+    def __init__(self, loader, device="cuda"):
+        """
+        Args:
+            loader: a DataLoader returning (cur_data, src_data) batches.
+            device: the CUDA device to copy batches to.
+        """
+        self.loader = iter(loader)
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(device=self.device)
+        self.preload()
+
+    def preload(self):
+        """Fetches the next batch and starts copying it to the device on the
+        side stream."""
+        try:
+            self.next_batch = next(self.loader)
+        except StopIteration:
+            self.next_batch = None
+            return
+
+        with torch.cuda.stream(self.stream):
+            self.next_batch = self._to_device(self.next_batch)
+
+            for data in self.next_batch:
+                if "depth_scale" in data:
+                    finalize_deferred_depth(data)
+
+    def _to_device(self, data):
+        """Copies every tensor in a (nested) batch to the device."""
+        if isinstance(data, torch.Tensor):
+            return data.to(self.device, non_blocking=True)
+        if isinstance(data, dict):
+            return {key: self._to_device(value) for key, value in data.items()}
+        if isinstance(data, (list, tuple)):
+            return type(data)(self._to_device(value) for value in data)
+        return data
+
+    def _record_stream(self, data, stream):
+        """Marks every tensor in a (nested) batch as used by stream, so its
+        memory isn't reused while the stream still needs it."""
+        if isinstance(data, torch.Tensor):
+            data.record_stream(stream)
+        elif isinstance(data, dict):
+            for value in data.values():
+                self._record_stream(value, stream)
+        elif isinstance(data, (list, tuple)):
+            for value in data:
+                self._record_stream(value, stream)
+
+    def next(self):
+        """Returns the next batch on the device, or None when the loader is
+        exhausted."""
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_stream(self.stream)
+
+        batch = self.next_batch
+        if batch is not None:
+            self._record_stream(batch, current_stream)
+
+        self.preload()
+
+        return batch
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        batch = self.next()
+        if batch is None:
+            raise StopIteration
+
+        return batch